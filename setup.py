@@ -23,7 +23,6 @@ setup(
     install_requires=[
         'python-swiftclient',
         'python-keystoneclient',
-        'pyinputplus',
         'coloredlogs',
         'humanize',
     ],
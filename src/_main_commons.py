@@ -2,20 +2,19 @@
 Contains secondary function for the main command line.
 """
 
+import functools
 import sys
 import stat
 import os
 import logging
 import logging.handlers
 from dataclasses import dataclass
-from typing import Sequence, TextIO
+from typing import Callable, Optional, Sequence
 from contextlib import suppress
 
 from ansi.print_lines import print_lines as ansi_print_lines
 from ansi import colors
 
-import coloredlogs
-
 _SYSLOG_SOCKET = "/dev/log"
 _log = logging.getLogger(__name__)
 
@@ -29,6 +28,8 @@ class Ctx:
     container_name: str
     temp_dir_name: str
     age_recipient: str
+    compressed_data: bool
+    max_incremental_depth: Optional[int]
     use_syslog: bool
     is_interactive: bool
     dry_run: bool
@@ -37,10 +38,26 @@ class Ctx:
         """Does the script execution context allows for fancy ansi escape code"""
         return self.is_interactive and not self.use_syslog
 
+    def green_fn(self) -> Callable[[str], str]:
+        """Function coloring its input in green, if execution context allows it"""
+        return colors.in_green if self.supports_fancy_output() else _identity
+
+    def red_fn(self) -> Callable[[str], str]:
+        """Function coloring its input in red, if execution context allows it"""
+        return colors.in_red if self.supports_fancy_output() else _identity
+
+
+def _identity(s: str) -> str:
+    return s
+
 
 def print_lines(lines: Sequence[str], ctx: Ctx):
     """Wraps ansi.print_lines with setup specific to the script execution"""
     append_only = not ctx.supports_fancy_output() or ctx.verbose
+    if not append_only:
+        # Fancy output logs bare messages to stderr, printing them directly
+        # allows redrawing with a single write
+        return ansi_print_lines(lines=lines, append_only=False, file=sys.stderr)
     return ansi_print_lines(
         lines=lines,
         append_only=append_only,
@@ -50,39 +67,77 @@ def print_lines(lines: Sequence[str], ctx: Ctx):
 
 
 def in_green(s: str, ctx: Ctx):
-    if not ctx.supports_fancy_output():
-        return s
-    return colors.in_green(s)
+    return ctx.green_fn()(s)
 
 
 def in_red(s: str, ctx: Ctx):
-    if not ctx.supports_fancy_output():
-        return s
-    return colors.in_red(s)
+    return ctx.red_fn()(s)
+
+
+def _prompt_yes_no(default_str: str) -> str:
+    """Read user input until it is a yes/no answer. Blank input means default_str"""
+    while True:
+        answer = input().strip().lower() or default_str
+        if answer in ("y", "yes"):
+            return "yes"
+        if answer in ("n", "no"):
+            return "no"
+        print(f"'{answer}' is not a valid yes/no response.", file=sys.stderr)
+
+
+def _ask_yes_no_question(question: str, ctx: Ctx, default: bool = False) -> bool:
+    """
+    Prompt a yes/no question to stderr and read/parse user response.
+    If script is non-interactive, then it prompt the question
+    with the default answer and proceed without user input
+    """
+    default_str = "yes" if default else "no"
+    suffix = "[Y/n]" if default else "[y/N]"
+
+    prompt_str = f"{question} {suffix} "
+    answer = default_str
+    if ctx.is_interactive:
+        print(prompt_str, end="", file=sys.stderr)
+        answer = _prompt_yes_no(default_str)
+    else:
+        print(f"{prompt_str} {default_str}", file=sys.stderr)
+
+    answer = answer or default_str
+
+    return answer == "yes"
+
+
+@functools.lru_cache(maxsize=1)
+def _syslog_socket_ok() -> bool:
+    """Checks that syslogd socket exists"""
+    with suppress(OSError):
+        return stat.S_ISSOCK(os.stat(_SYSLOG_SOCKET).st_mode)
+    return False
+
+
+@functools.lru_cache(maxsize=2)
+def _formatter(is_tty: bool) -> logging.Formatter:
+    """Formatter of console logs, colored when outputting to a tty"""
+    if is_tty:
+        import coloredlogs
+
+        return coloredlogs.ColoredFormatter("%(message)s")
+    return logging.Formatter("%(levelname)s - %(message)s")
 
 
 def _configure_logging(context: Ctx):
     verbose = context.verbose
     use_syslog = context.use_syslog
 
-    def _formatter(stream: TextIO):
-        return (
-            coloredlogs.ColoredFormatter("%(message)s")
-            if stream.isatty()
-            else logging.Formatter("%(levelname)s - %(message)s")
-        )
-
     level = logging.DEBUG if verbose else logging.INFO
-    syslog_socket_ok = False
-    with suppress(BaseException):
-        syslog_socket_ok = stat.S_ISSOCK(os.stat(_SYSLOG_SOCKET).st_mode)
+    syslog_socket_ok = use_syslog and _syslog_socket_ok()
 
     handler = None
     if use_syslog and syslog_socket_ok:
         handler = logging.handlers.SysLogHandler(address=_SYSLOG_SOCKET)
     else:
         stream_handler = logging.StreamHandler()
-        formatter = _formatter(stream_handler.stream)  # type: ignore
+        formatter = _formatter(stream_handler.stream.isatty())  # type: ignore
         stream_handler.setFormatter(formatter)
         handler = stream_handler  # type: ignore
 
@@ -16,13 +16,16 @@ bright_green = f"{_prefix}[32;1m"
 bright_yellow = f"{_prefix}[33;1m"
 reset = _reset
 
+_GREEN = f"{green}%s{reset}"
+_RED = f"{red}%s{reset}"
+
 def in_green(s: str):
     """Color input in green"""
-    return f'{green}{s}{reset}'
+    return _GREEN % (s,)
 
 def in_red(s: str):
-    """Color input in green"""
-    return f'{red}{s}{reset}'
+    """Color input in red"""
+    return _RED % (s,)
 
 def color256(id: int):
     """Return color ID from 256 color palette"""
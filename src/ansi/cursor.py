@@ -7,6 +7,10 @@ from . import _print
 
 import sys
 
+_LINEUP_CACHE_SIZE = 64
+_LINEUP = tuple(f"{_prefix}[{n}F" for n in range(_LINEUP_CACHE_SIZE))
+"""Line up escape codes, indexed by number of lines"""
+
 def up(n=1, file=None):
     """Move cursor n upward"""
     file = file or sys.stdout
@@ -43,7 +47,8 @@ def loadpos(file=None):
 
 def lineup(n=0, file=None):
     file = file or sys.stdout
-    _print(f"{_prefix}[{n}F", file=file)
+    code = _LINEUP[n] if 0 <= n < _LINEUP_CACHE_SIZE else f"{_prefix}[{n}F"
+    _print(code, file=file)
 
 
 def linedown(n=0, file=None):
@@ -13,6 +13,10 @@ class ClearLineType(enum.Enum):
     ENTIRE = 2
 
 
+_CLEARLINE = tuple(f"{_prefix}[{t.value}K" for t in ClearLineType)
+"""Clear line escape codes, indexed by ClearLineType value"""
+
+
 def clearline(type: ClearLineType = ClearLineType.ENTIRE, file = None):
     file = file or sys.stdout
-    _print(f"{_prefix}[{type.value}K", file=file)
\ No newline at end of file
+    _print(_CLEARLINE[type.value], file=file)
\ No newline at end of file
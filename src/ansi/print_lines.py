@@ -1,11 +1,13 @@
 import contextlib
 import sys
 from . import _print
-from .cursor import lineup
-from .line import clearline
+from .cursor import _LINEUP
+from .line import _CLEARLINE, ClearLineType
 from typing import Iterable, Optional, Sequence, TextIO
 
 _DEFAULT_PRINTFN = lambda line, file: _print(line, end="\n", file=file)
+_ERASE_LINE = _LINEUP[1] + _CLEARLINE[ClearLineType.ENTIRE.value]
+"""Moves cursor to the previous line and clears it, same as lineup(1) then clearline()"""
 
 
 @contextlib.contextmanager
@@ -50,12 +52,7 @@ class _SequencePrinter:
 
     @staticmethod
     def _read_lines(content: Iterable[str]) -> tuple[str, ...]:
-        acc = []
-        for line in content:
-            for y in line.splitlines():
-                acc.append(y)
-
-        return tuple(acc)
+        return tuple(y for line in content for y in line.splitlines())
 
     def __init__(
         self,
@@ -74,15 +71,23 @@ class _SequencePrinter:
         previous = self.__content
         current = self._read_lines(content)
 
+        erase = ""
         if not self.__append_only:
-            for _ in previous:
-                lineup(1, file=self.__file)
-                clearline(file=self.__file)
+            erase = _ERASE_LINE * len(previous)
 
         self.__content = current
-        self._draw()
+        self._draw(erase)
+
+    def _draw(self, erase: str = ""):
+        """Draw content, preceded by 'erase' escape sequence"""
+        if self.__printfn is _DEFAULT_PRINTFN:
+            # A whole frame in one write, instead of flushed prints per escape code and line
+            self.__file.write(erase + "".join(f"{line}\n" for line in self.__content))
+            self.__file.flush()
+            return
 
-    def _draw(self):
+        if erase:
+            _print(erase, file=self.__file)
         for line in self.__content:
             self.__printfn(str(line), file=self.__file)
 
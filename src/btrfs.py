@@ -1,15 +1,24 @@
 """
 Module holding operation directly related to btrfs.
 """
+import functools
+import heapq
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import Optional
 from uuid import UUID
 
 import btrfsutil
 
 TOP_LEVEL_SUBVOL_ID = 5
 
+_MAX_PROBE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+"""Upper bound of concurrent ioctls issued while probing subvolumes"""
+_SERIAL_PROBE_MAX = 16
+"""Up to this many snapshots, probing them in turn is cheaper than starting a thread pool"""
+
 _log = logging.getLogger(__name__)
 
 
@@ -17,6 +26,9 @@ _log = logging.getLogger(__name__)
 class Snapshot:
     """Represents a local btrfs snapshot"""
 
+    # Explicit __slots__ rather than dataclass(slots=True), which requires python 3.10
+    __slots__ = ("parent_uuid", "rel_path", "abs_path", "otime")
+
     parent_uuid: str
     """UUID string of parent subvolume. (which subvolume is represented by this snapshots)"""
     rel_path: str
@@ -34,6 +46,8 @@ class Snapshot:
 class SnapshotsDifference:
     """Represents the difference between two snapshots"""
 
+    __slots__ = ("parent", "snapshot")
+
     parent: Snapshot
     snapshot: Snapshot
 
@@ -41,47 +55,75 @@ class SnapshotsDifference:
         return f"changes between {self.parent} and {self.snapshot}"
 
 
+@functools.lru_cache(maxsize=64)
 def _compute_root_path(path):
-    """Compute the path of the root filesystem from subvolume path given in argument"""
-    norm_path = os.path.normpath(path)
-    rel_path = btrfsutil.subvolume_path(norm_path)
-    root_path = os.path.normpath(norm_path.removesuffix(rel_path))
+    """
+    Compute the path of the root filesystem from subvolume path given in argument.
+    'path' is expected to be absolute and normalized, as returned by os.path.abspath
+    """
+    rel_path = btrfsutil.subvolume_path(path)
+    root_path = os.path.normpath(path.removesuffix(rel_path))
     _log.debug(
-        f'Given path "{norm_path}" with its relative part "{rel_path}". root filesystem path is "{root_path}"'
+        'Given path "%s" with its relative part "%s". root filesystem path is "%s"',
+        path,
+        rel_path,
+        root_path,
     )
     return root_path
 
 
+@functools.lru_cache(maxsize=64)
+def _cached_uuid(path) -> bytes:
+    """UUID bytes of subvolume designated by 'path'"""
+    return btrfsutil.subvolume_info(path).uuid
+
+
 def find_ro_snapshots_of(path) -> list[Snapshot]:
     """
     Look for read only snapshots of subvolume designated by 'path'.
     Returns list of paths (relative to rootfs) of RO snapshots sorted chronologically based on creation time.
     """
     path = os.path.abspath(path)
-    ro_snapshots: list[Snapshot] = []
     root_fs_path = _compute_root_path(path)
-    uuid = UUID(bytes=btrfsutil.subvolume_info(path).uuid)
-    uuid_str = str(uuid)
-    _log.debug(f'Looking for readonly snapshot of "{path}" which has uuid "{uuid_str}"')
-
-    with btrfsutil.SubvolumeIterator(path, TOP_LEVEL_SUBVOL_ID) as it:
-        for curr_path_, id_ in it:
-            curr_fullpath_ = os.path.normpath(os.path.join(root_fs_path, curr_path_))
-            info = btrfsutil.subvolume_info(path, id_)
-            curr_parent_uuid = UUID(bytes=info.parent_uuid)
-            otime = info.otime
-            ro = btrfsutil.get_subvolume_read_only(curr_fullpath_)
-            # debug(f'Checking if "{curr_fullpath_}" is readonly: "{ro}"')
-            if curr_parent_uuid == uuid and ro:
-                snapshot = Snapshot(
-                    parent_uuid=str(curr_parent_uuid),
-                    rel_path=curr_path_,
-                    abs_path=curr_fullpath_,
-                    otime=otime,
-                )
-                ro_snapshots.append(snapshot)
-
-    _log.debug(f"ro_snapshots: {ro_snapshots}")
-    ro_snapshots = sorted(ro_snapshots, key=lambda x: x.otime)
-    _log.debug(f"ro_snapshots: {ro_snapshots}")
+    uuid_bytes = _cached_uuid(path)
+    uuid_str = str(UUID(bytes=uuid_bytes))
+    # root_fs_path is normalized, and iterated paths are clean relative paths
+    root_prefix = root_fs_path.rstrip("/")
+    _log.debug('Looking for readonly snapshot of "%s" which has uuid "%s"', path, uuid_str)
+
+    def _probe(curr_path_, info) -> Optional[Snapshot]:
+        curr_fullpath_ = f"{root_prefix}/{curr_path_}"
+        ro = btrfsutil.get_subvolume_read_only(curr_fullpath_)
+        # debug(f'Checking if "{curr_fullpath_}" is readonly: "{ro}"')
+        if not ro:
+            return None
+
+        return Snapshot(
+            parent_uuid=uuid_str,
+            rel_path=curr_path_,
+            abs_path=curr_fullpath_,
+            otime=info.otime,
+        )
+
+    # info=True yields subvolume infos during the tree search, sparing one ioctl per subvolume.
+    # Filtering in place leaves only snapshots of the subvolume to probe
+    with btrfsutil.SubvolumeIterator(path, TOP_LEVEL_SUBVOL_ID, info=True) as it:
+        candidates = [(p, info) for p, info in it if info.parent_uuid == uuid_bytes]
+
+    if len(candidates) <= _SERIAL_PROBE_MAX:
+        probed = [_probe(*c) for c in candidates]
+    else:
+        # ioctls release the GIL, probing subvolumes concurrently saves the syscall serialization
+        with ThreadPoolExecutor(max_workers=_MAX_PROBE_WORKERS) as executor:
+            probed = list(executor.map(lambda c: _probe(*c), candidates))
+
+    # Index breaks otime ties, keeping snapshots themselves out of comparisons
+    heap: list[tuple[float, int, Snapshot]] = []
+    for i, s in enumerate(probed):
+        if s is not None:
+            heapq.heappush(heap, (s.otime, i, s))
+
+    ro_snapshots = [heapq.heappop(heap)[2] for _ in range(len(heap))]
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("ro_snapshots: %r", ro_snapshots)
     return ro_snapshots
@@ -2,19 +2,30 @@
 Module related to business logic.
 """
 
-from typing import Iterator, Sequence
+from typing import Iterable, Iterator, Optional, Sequence
 from btrfs import Snapshot, SnapshotsDifference
 from storage import compute_storage_filename, ContentToArchive
 from exceptions import ProgrammingError
 
+import fcntl
 import os
 import logging
 import subprocess
 import shutil
 import contextlib
+import functools
+import queue
+import threading
+import itertools
 
 _log = logging.getLogger(__name__)
 
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)  # Exposed by fcntl since python 3.10
+_PIPE_SIZE = 1024 * 1024
+"""Pipe buffer size between processes of the preparation. Linux default pipe-max-size"""
+_PROGRESS_POLL_INTERVAL = 0.25
+"""Seconds between checks of preparation processes while waiting for progress"""
+
 class UnexpectedSnapshotStorageLayout(Exception):
     """Raised when local snapshots and distant stored snapshots differs too much to be reliable"""
 
@@ -25,10 +36,31 @@ def unequal_snapshots_ex(s1, s2) -> UnexpectedSnapshotStorageLayout:
     raise UnexpectedSnapshotStorageLayout(f"{s1} should equals {s2}")
 
 
-def compute_snapshot_to_archive(snapshots: Sequence[Snapshot], archived: Sequence[Snapshot]) -> Iterator[ContentToArchive]:
+def _validate(snapshots: Sequence[Snapshot]):
+    """
+    Raises:
+      ValueError: If snapshots contains duplicates or None values
+    """
+    seen = set(snapshots)
+    if len(snapshots) != len(seen):
+        raise ValueError("We shouldn't have duplicate snapshots")
+    if None in seen:
+        raise ValueError("snapshots should not contains None values")
+
+
+def compute_snapshot_to_archive(
+    snapshots: Sequence[Snapshot],
+    archived: Sequence[Snapshot],
+    max_incremental_depth: Optional[int] = None,
+) -> Iterator[ContentToArchive]:
     """
     Compute snapshots to archive,
 
+    Args:
+      max_incremental_depth: maximum number of consecutive differences
+        before archiving a full snapshot again. Unbounded if None.
+        Full snapshots are placed on indexes of snapshots multiple of
+        max_incremental_depth + 1, so that placement is stable between runs.
     Returns:
       generator of content to archive
     Raises:
@@ -36,29 +68,25 @@ def compute_snapshot_to_archive(snapshots: Sequence[Snapshot], archived: Sequenc
          consistent with local ones.
       ValueError: If snapshots contains duplicates, none...
     """
-    def sane_check(snapshots):
-        if len(snapshots) != len(set(snapshots)):
-            raise ValueError("We shouldn't have duplicate snapshots")
-        if None in snapshots:
-            raise ValueError("snapshots should not contains None values")
-
     def snapshot_or_diff(parent, snapshot):
         if parent is None:
             return snapshot
         else:
             return SnapshotsDifference(parent, snapshot)
 
-    def chain_of(snapshots: Sequence[Snapshot]):
-        chain = []
+    def chain_of(snapshots: Iterable[Snapshot], start: int = 0) -> Iterator[ContentToArchive]:
         parent = None
-        for s in snapshots:
-            chain.append(snapshot_or_diff(parent, s))
+        for i, s in enumerate(snapshots, start):
+            if max_incremental_depth is not None and i % (max_incremental_depth + 1) == 0:
+                parent = None
+            yield snapshot_or_diff(parent, s)
             parent = s
-        return chain
-    
 
-    sane_check(snapshots)
-    sane_check(archived)
+    if max_incremental_depth is not None and max_incremental_depth < 0:
+        raise ValueError("max_incremental_depth should not be negative")
+
+    _validate(snapshots)
+    _validate(archived)
 
     if not snapshots:
         return
@@ -68,24 +96,57 @@ def compute_snapshot_to_archive(snapshots: Sequence[Snapshot], archived: Sequenc
     if len(snapshots) == len(archived):
         return
     
-    corresponding_archives = tuple(
-        archived[i] if i < len(archived) else None
-        for i in range(len(snapshots))
-    )
-    assert len(snapshots) == len(corresponding_archives)
+    # Archived snapshots must be the oldest local snapshots, in the same order
+    mismatch = next(((s, a) for s, a in zip(snapshots, archived) if s != a), None)
+    if mismatch is not None:
+        raise unequal_snapshots_ex(*mismatch)
+
+    n_archived = min(len(snapshots), len(archived))
+    chain = itertools.chain((archived[n_archived - 1],), snapshots[n_archived:])
+    yield from itertools.islice(chain_of(chain, start=n_archived - 1), 1, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _which(cmd: str):
+    """Cached shutil.which, PATH isn't expected to change during execution"""
+    return shutil.which(cmd)
 
-    chain = []
-    for i, (s, a) in enumerate(zip(snapshots, corresponding_archives)):
-        if a is not None and s != a:
-            raise unequal_snapshots_ex(s, a)
 
-        if a is not None:
-            chain = [a]
-            continue
-        chain += snapshots[i:]
-        break
+def _enlarge_pipe(pipe):
+    """Grow pipe buffer, for less context switches between the processes on its ends"""
+    with contextlib.suppress(OSError):  # pipe-max-size may be lower for unprivileged users
+        fcntl.fcntl(pipe.fileno(), _F_SETPIPE_SZ, _PIPE_SIZE)
 
-    yield from (chain_of(chain)[1:])
+
+@functools.lru_cache(maxsize=None)
+def _send_supports_compressed_data(which_btrfs: str) -> bool:
+    """Does installed btrfs send support --compressed-data (btrfs-progs >= 5.19)"""
+    usage = subprocess.run(
+        [which_btrfs, "send", "--help"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    ).stdout
+    return "--compressed-data" in usage
+
+
+def _drain_progress(fd: int, lines: queue.SimpleQueue):
+    """
+    Puts progress lines of pv read from 'fd' in 'lines', then None once pv closed it.
+    Takes ownership of 'fd'.
+    """
+    pending = b""
+    with open(fd, "rb", buffering=0) as stream:
+        while chunk := stream.read(4096):
+            # pv separates its reports with '\r'
+            *complete, pending = (pending + chunk).replace(b"\r", b"\n").split(b"\n")
+            for line in complete:
+                if line.strip():
+                    lines.put(line.decode(errors="replace").rstrip())
+    if pending.strip():
+        lines.put(pending.decode(errors="replace").rstrip())
+    lines.put(None)
 
 
 class PrepareContentEx(Exception):
@@ -102,20 +163,33 @@ class PrepareContent:
         that we will be turning in a file beforehand.
       dirname (str): directory in which we will store the file.
         Consider that arbitrary change to existing files in that directory may happen.
+      compressed_data (bool): use send stream protocol v2,
+        forwarding compressed extents without decompressing them.
     Raises:
       PrepareContentEx
     """
 
-    def __init__(self, content: ContentToArchive, dirname: str, age_recipient: str):
+    def __init__(
+        self,
+        content: ContentToArchive,
+        dirname: str,
+        age_recipient: str,
+        compressed_data: bool = False,
+    ):
 
         self.__content = content
         self.__dirname = os.path.abspath(dirname)
         self.__basename = compute_storage_filename(self.__content)
         self.__path = os.path.join(self.__dirname, self.__basename)
         self.__age_recipient = age_recipient
-        which_btrfs = shutil.which("btrfs")
-        which_pv = shutil.which("pv")
-        which_age = shutil.which("age")
+        self.__compressed_data = compressed_data
+        self.__size: Optional[int] = None
+        self.__lock = threading.Lock()
+        self.__processes: list = []
+        self.__aborted = False
+        which_btrfs = _which("btrfs")
+        which_pv = _which("pv")
+        which_age = _which("age")
 
         if not os.path.isdir(self.__dirname):
             raise PrepareContentEx(f"{self.__dirname} does not exist.")
@@ -125,6 +199,8 @@ class PrepareContent:
             raise PrepareContentEx(f"btrfs must be in path!")
         if self.__age_recipient and not which_age:
             raise PrepareContentEx(f"age must be in path!")
+        if self.__compressed_data and not _send_supports_compressed_data(which_btrfs):
+            raise PrepareContentEx(f"btrfs send does not support --compressed-data!")
 
         self.__which_btrfs: str = which_btrfs
         self.__which_pv = which_pv
@@ -134,8 +210,14 @@ class PrepareContent:
         """Path in which the file is/will be stored in the preparation"""
         return self.__path
 
+    def prepared_size(self) -> int:
+        """Size in bytes of the prepared file. Only known once preparation is done"""
+        if self.__size is None:
+            raise ProgrammingError("Content is not prepared yet")
+        return self.__size
 
-    def prepare(self, ratelimit = None) -> Iterator[str]:
+
+    def prepare(self, ratelimit = None, progress: bool = True) -> Iterator[str]:
         """
         Prepare the content to the target_path.
         It uses btrfs send
@@ -145,29 +227,83 @@ class PrepareContent:
         Args:
           ratelimit: ratelimit of transfer speed in quantity per seconds. 
             Accepts input like 100 (100B/s), 1K (1K/s), 1M, 1G...
+          progress: whether completion progress is wanted. When it is not,
+            and no ratelimit is set, content doesn't go through pv at all.
         """
+        piped_to_pv = bool(self.__which_pv) and (progress or bool(ratelimit))
+        piped_to_age = bool(self.__age_recipient)
         #fmt:off
-        with open(self.__path, "x") as file, \
+        with self._open_target() as file, \
              self._send_process(stdout= \
-                 (subprocess.PIPE if (self.__which_pv or self.__age_recipient) else file)\
+                 (subprocess.PIPE if (piped_to_pv or piped_to_age) else file)\
              ) as send, \
-             self._age_process(stdin=send.stdout, stdout=subprocess.PIPE) as age, \
-             self._pv_process(stdin=(age.stdout if age else send.stdout), stdout=file, ratelimit=ratelimit) as pv:
+             self._age_process(stdin=send.stdout, stdout=(subprocess.PIPE if piped_to_pv else file)) as age, \
+             self._pv_process(stdin=(age.stdout if age else send.stdout), stdout=file, ratelimit=ratelimit, enabled=piped_to_pv) as pv:
         #fmt:on
-            processes = [send]
+            # Content flows from process to process through kernel pipes, never through us.
+            # Dropping our copies of the pipe ends lets a writer get SIGPIPE if its reader dies.
+            for p in (send, age):
+                if p is not None and p.stdout is not None:
+                    _enlarge_pipe(p.stdout)
+                    p.stdout.close()
+
+            processes = [p for p in (send, age) if p is not None]
+            self._track([*processes, pv])
 
             if pv is not None:
+                yield from self._follow_progress(pv, upstream=processes)
                 processes += [pv]
-                for line in pv.stderr:
-                    yield line.rstrip()
 
             ret = [p.wait() for p in processes]
+            if self.__aborted:
+                raise PrepareContentEx("Preparation was aborted")
             if any([s != 0 for s in ret]):
                 raise PrepareContentEx("Error happened during btrfs send")
+
+            # Pages are kept on purpose, upload re-reads the file right after.
+            # They are dropped in release()
+            self.__size = os.fstat(file.fileno()).st_size
     
+    def abort(self):
+        """
+        Abort an ongoing or upcoming preparation, may be called from another thread.
+        Processes of the preparation are killed, prepare then raises PrepareContentEx.
+        """
+        with self.__lock:
+            self.__aborted = True
+            self._kill_tracked()
+
+    def _track(self, processes):
+        """Keep processes of the preparation, killing them right away if it was aborted"""
+        with self.__lock:
+            self.__processes = [p for p in processes if p is not None]
+            if self.__aborted:
+                self._kill_tracked()
+
+    def _kill_tracked(self):
+        for p in self.__processes:
+            if p.poll() is None:
+                p.kill()
+
+    def release(self):
+        """
+        Release the prepared content once it won't be accessed anymore.
+        The file is removed, freeing both its disk space and its page cache.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.__path)
+
+    def _open_target(self):
+        file = open(self.__path, "x")
+        # Content is written once, sequentially
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return file
+
     def _send_process(self, stdout):
         content = self.__content
         cmd = [self.__which_btrfs, "send"]
+        if self.__compressed_data:
+            cmd += ["--proto", "2", "--compressed-data"]
         if isinstance(content, SnapshotsDifference):
             cmd += ["-p", content.parent.abs_path, content.snapshot.abs_path]
         elif isinstance(content, Snapshot):
@@ -190,8 +326,34 @@ class PrepareContent:
         _log.debug(cmd)
         return subprocess.Popen(cmd, stdin=stdin, stdout=stdout)
 
-    def _pv_process(self, stdin, stdout, ratelimit):
-        if not self.__which_pv:
+    @staticmethod
+    def _follow_progress(pv, upstream) -> Iterator[str]:
+        """
+        Yields progress lines of pv until it closes its stderr.
+        Lines are read by a background thread, upstream processes are
+        checked meanwhile, so that a failure is reported as soon as it happens.
+        Raises:
+          PrepareContentEx
+        """
+        lines: queue.SimpleQueue = queue.SimpleQueue()
+        # The thread works on its own descriptor, pv.stderr gets closed when leaving prepare
+        fd = os.dup(pv.stderr.fileno())
+        threading.Thread(target=_drain_progress, args=(fd, lines), daemon=True).start()
+
+        while True:
+            try:
+                line = lines.get(timeout=_PROGRESS_POLL_INTERVAL)
+            except queue.Empty:
+                if any(p.poll() not in (None, 0) for p in upstream):
+                    raise PrepareContentEx("Error happened during btrfs send")
+                continue
+
+            if line is None:
+                return
+            yield line
+
+    def _pv_process(self, stdin, stdout, ratelimit, enabled=True):
+        if not enabled or not self.__which_pv:
             return contextlib.nullcontext()
 
         cmd = [self.__which_pv, "-i", "1", "-f"]
@@ -205,5 +367,4 @@ class PrepareContent:
             stdin=stdin,
             stderr=subprocess.PIPE,
             stdout=stdout,
-            text=True,
         )
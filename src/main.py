@@ -1,21 +1,19 @@
 #!/usr/bin/env python3
 
+import contextlib
 import logging
 import logging.handlers
-from typing import Sequence
+from typing import AbstractSet, FrozenSet, Iterable, Iterator, Optional, Sequence
 import os
 import sys
 import tempfile
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import btrfs
 import argparse
 
-from humanize import naturalsize
-from humanize import precisedelta
-import pyinputplus as pyin
-
-from storage import only_stored, upload
+from storage import compute_storage_filename, only_stored, swift_service, upload
 from business import (
     UnexpectedSnapshotStorageLayout,
     PrepareContent,
@@ -24,93 +22,200 @@ from business import (
 )
 
 
-from _main_commons import Ctx, print_lines, in_green, in_red, _configure_logging
+from _main_commons import (
+    Ctx,
+    print_lines,
+    in_green,
+    in_red,
+    _ask_yes_no_question,
+    _configure_logging,
+)
 
 
 from _main_commons import _SYSLOG_SOCKET
 
 _log = logging.getLogger(__name__)
 
+_PROGRESS_MIN_INTERVAL = 0.1
+"""Minimum seconds between two redraws of upload progress"""
 
-def _look_for_archived_snapshots(ro_snapshots, ctx: Ctx) -> Sequence[btrfs.Snapshot]:
+
+def _look_for_archived_snapshots(
+    ro_snapshots, ctx: Ctx, swift, known_stored: FrozenSet[str]
+) -> Sequence[btrfs.Snapshot]:
     """
     Look for archived snapshots in storage
+    Args:
+      known_stored: storage filenames known to be stored, which storage is not requested for
 
     Returns:
       sequence of archived snapshots
     """
-    lines = [s.rel_path for s in ro_snapshots]
-    lines += [f"Requesting Web Archive... ⏳"]
+    lines = [*(s.rel_path for s in ro_snapshots), "Requesting Web Archive... ⏳"]
     archived_snapshots: Sequence = []
 
     with print_lines(lines, ctx) as printer:
 
-        archived_snapshots = only_stored(ro_snapshots, ctx.container_name)
-
-        in_cloud_str = in_green("in ☁️", ctx)
-        not_in_cloud_str = in_red("not in ☁️", ctx)
-        lines = [
-            f"{s.rel_path}... {in_cloud_str if s in archived_snapshots else not_in_cloud_str}"
-            for s in ro_snapshots
-        ]
+        archived_snapshots = only_stored(
+            ro_snapshots, ctx.container_name, swift, known_stored
+        )
+        archived_set = frozenset(archived_snapshots)
+
+        # Coloring depends on ctx, statuses are formatted once per call rather than at import
+        suffix = {
+            True: f"... {in_green('in ☁️', ctx)}",
+            False: f"... {in_red('not in ☁️', ctx)}",
+        }
+        lines = [s.rel_path + suffix[s in archived_set] for s in ro_snapshots]
         printer.reprint(lines)
 
     return archived_snapshots
 
 
-def _prepare_snapshot_to_archive(to_archive, ctx: Ctx) -> str:
+def _new_preparator(to_archive: ContentToArchive, ctx: Ctx) -> PrepareContent:
+    return PrepareContent(
+        to_archive, ctx.temp_dir_name, ctx.age_recipient, ctx.compressed_data
+    )
+
+
+def _prepare_snapshot_to_archive(preparator: PrepareContent, ctx: Ctx) -> PrepareContent:
     """
     Prepare snapshot to archive in a local file
 
     Returns:
-      fullpath of the file to archive
+      the preparator, which target_path is the fullpath of the file to archive
     """
-    start = time.time()
+    from humanize import naturalsize, precisedelta
 
-    preparator = PrepareContent(to_archive, ctx.temp_dir_name, ctx.age_recipient)
+    start = time.time()
     filepath = preparator.target_path()
 
     with print_lines(["Initializing preparation ⏳"], ctx) as printer:
-        for progress_line in preparator.prepare():
-            if ctx.is_interactive:
-                printer.reprint([progress_line])
+        for progress_line in preparator.prepare(progress=ctx.is_interactive):
+            printer.reprint([progress_line])
 
         elapsed = precisedelta(time.time() - start)
-        size = naturalsize(os.path.getsize(filepath))
+        size = naturalsize(preparator.prepared_size())
         printer.reprint([f"Preparation is {size}, took {elapsed}. Ready to upload 💪"])
 
-    _log.debug(f"Preparation fullpath: {filepath}")
-    return filepath
+    _log.debug("Preparation fullpath: %s", filepath)
+    return preparator
+
+
+_UPLOADED_INDEX_DIRNAME = "btrfs-to-swift"
+"""Directory of user cache holding indexes of uploaded contents"""
 
 
-def _ask_yes_no_question(question: str, ctx: Ctx, default: bool = False) -> bool:
+@contextlib.contextmanager
+def _uploaded_index_dir() -> Iterator[Optional[int]]:
     """
-    Prompt a yes/no question to stderr and read/parse user response.
-    If script is non-interactive, then it prompt the question
-    with the default answer and proceed without user input
+    Descriptor of the private directory holding indexes of uploaded contents, created if needed.
+    None if it can't be trusted: anyone else than us should neither own nor access it.
+    Indexes are opened relative to the descriptor, so the directory can't be swapped meanwhile.
     """
-    default_str = "yes" if default else "no"
-    suffix = "[Y/n]" if default else "[y/N]"
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    dirname = os.path.join(cache_home, _UPLOADED_INDEX_DIRNAME)
+    try:
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError as e:
+        _log.warning(f"Not using index of uploaded contents, {dirname} is unusable: {e}")
+        yield None
+        return
 
-    prompt_str = f"{question} {suffix} "
-    answer = default_str
-    if ctx.is_interactive:
-        print(prompt_str, end="", file=sys.stderr)
-        answer = pyin.inputYesNo(blank=True, default=default_str)
-    else:
-        print(f"{prompt_str} {default_str}", file=sys.stderr)
+    try:
+        st = os.fstat(fd)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            _log.warning(
+                f"Not using index of uploaded contents, {dirname} should only be accessible by you"
+            )
+            yield None
+        else:
+            yield fd
+    finally:
+        os.close(fd)
+
+
+def _uploaded_index_name(s: btrfs.Snapshot, ctx: Ctx) -> str:
+    """Name of the file recording contents uploaded to the container, for snapshots of s's subvolume"""
+    return f"uploaded.{ctx.container_name}.{s.parent_uuid}"
+
+
+def _read_uploaded_index(s: btrfs.Snapshot, ctx: Ctx) -> FrozenSet[str]:
+    """Storage filenames recorded as uploaded, for snapshots of s's subvolume"""
+    with _uploaded_index_dir() as dir_fd:
+        if dir_fd is None:
+            return frozenset()
+        try:
+            fd = os.open(
+                _uploaded_index_name(s, ctx), os.O_RDONLY | os.O_NOFOLLOW, dir_fd=dir_fd
+            )
+            with open(fd) as f:
+                return frozenset(line.strip() for line in f if line.strip())
+        except OSError:
+            return frozenset()
+
+
+def _write_uploaded_index(s: btrfs.Snapshot, names: Iterable[str], ctx: Ctx, append: bool):
+    """Write storage filenames to the index of s's subvolume, appending them or replacing its content"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW | (os.O_APPEND if append else os.O_TRUNC)
+    name = _uploaded_index_name(s, ctx)
+    with _uploaded_index_dir() as dir_fd:
+        if dir_fd is None:
+            return
+        try:
+            fd = os.open(name, flags, 0o600, dir_fd=dir_fd)
+            with open(fd, "w") as f:
+                f.write("".join(f"{n}\n" for n in names))
+        except OSError as e:
+            _log.warning(f"Could not write index of uploaded contents {name}: {e}")
+
+
+def _record_uploaded(content_to_archive: ContentToArchive, ctx: Ctx):
+    """Append uploaded content to local index"""
+    snapshot = content_to_archive
+    if isinstance(content_to_archive, btrfs.SnapshotsDifference):
+        snapshot = content_to_archive.snapshot
+    name = compute_storage_filename(content_to_archive)
+    _write_uploaded_index(snapshot, (name,), ctx, append=True)
+
+
+def _drop_uploaded(
+    s: btrfs.Snapshot, uploaded: FrozenSet[str], missing: AbstractSet[str], ctx: Ctx
+):
+    """Drop from the index of s's subvolume recorded contents which storage doesn't have"""
+    _log.warning(
+        f"{len(missing)} contents recorded as uploaded are not in storage, forgetting them"
+    )
+    _write_uploaded_index(s, sorted(uploaded - missing), ctx, append=False)
 
-    answer = answer or default_str
 
-    return answer == "yes"
+def _confirm_uploaded(
+    snapshots: Sequence[btrfs.Snapshot], uploaded: FrozenSet[str], ctx: Ctx, swift
+) -> FrozenSet[str]:
+    """
+    Storage filenames of the index which can be taken as stored.
+    The newest recorded snapshot, parent of the next difference to upload,
+    is checked against storage. When storage doesn't have it, the index is stale
+    and none of its records can be trusted.
+    """
+    recorded = [s for s in snapshots if compute_storage_filename(s) in uploaded]
+    if not recorded or only_stored(recorded[-1:], ctx.container_name, swift):
+        return uploaded
+    _log.warning(
+        f"{recorded[-1].rel_path} is recorded as uploaded but not in storage, checking every snapshot"
+    )
+    return frozenset()
 
 
 def _ask_preparing(to_archive: ContentToArchive, ctx: Ctx):
     return _ask_yes_no_question(f"Prepare {str(to_archive)}?", ctx=ctx, default=True)
 
 
-def _ask_archiving(to_archive: ContentToArchive, filepath: str, ctx: Ctx) -> bool:
-    size = naturalsize(os.path.getsize(filepath))
+def _ask_archiving(to_archive: ContentToArchive, filesize: int, ctx: Ctx) -> bool:
+    from humanize import naturalsize
+
+    size = naturalsize(filesize)
     return _ask_yes_no_question(
         f"Upload backup of {str(to_archive)} ({size}) to container '{ctx.container_name}'?",
         ctx=ctx,
@@ -118,6 +223,97 @@ def _ask_archiving(to_archive: ContentToArchive, filepath: str, ctx: Ctx) -> boo
     )
 
 
+def _upload_prepared(
+    content_to_archive: ContentToArchive, preparator: PrepareContent, ctx: Ctx, swift
+):
+    """Upload prepared content, then release it"""
+    from humanize import naturalsize
+
+    filepath = preparator.target_path()
+    filesize = preparator.prepared_size()
+
+    msg_prefix = f" ⏳ Uploading {content_to_archive}."
+    progress_prefix = f"{msg_prefix} "
+    progress_suffix = f"/{naturalsize(filesize)}"
+    last_reprint = 0.0
+    with print_lines([f"{msg_prefix} This might take awhile."], ctx) as printer:
+        for transferred in upload(filepath, ctx.container_name, filesize, swift):
+            now = time.monotonic()
+            if ctx.is_interactive and now - last_reprint >= _PROGRESS_MIN_INTERVAL:
+                printer.reprint([progress_prefix + naturalsize(transferred) + progress_suffix])
+                last_reprint = now
+        printer.reprint([f"Uploaded {content_to_archive} 💪"])
+    preparator.release()
+    _record_uploaded(content_to_archive, ctx)
+
+
+def _archive_sequentially(
+    content_to_archive_list: Sequence[ContentToArchive], ctx: Ctx, swift
+):
+    """Prepare then upload each content, one after another, asking user before each step"""
+    for content_to_archive in content_to_archive_list:
+
+        consent = _ask_preparing(content_to_archive, ctx=ctx)
+        if not consent:
+            _log.info("You refused, bybye")
+            return
+
+        preparator = _prepare_snapshot_to_archive(
+            _new_preparator(content_to_archive, ctx), ctx
+        )
+
+        if ctx.dry_run:
+            preparator.release()
+            continue
+
+        consent = _ask_archiving(content_to_archive, preparator.prepared_size(), ctx=ctx)
+        if not consent:
+            _log.info("You refused, bybye")
+            return
+
+        _upload_prepared(content_to_archive, preparator, ctx, swift)
+
+
+def _archive_pipelined(
+    content_to_archive_list: Sequence[ContentToArchive], ctx: Ctx, swift
+):
+    """
+    Upload each content while preparing the next one.
+    Only meant for non-interactive execution, where questions are answered
+    with their default (yes) and outputs are appended.
+    """
+
+    def submit_preparation(content_to_archive):
+        _ask_preparing(content_to_archive, ctx=ctx)
+        preparator = _new_preparator(content_to_archive, ctx)
+        return preparer.submit(_prepare_snapshot_to_archive, preparator, ctx), preparator
+
+    preparer = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    try:
+        pending = submit_preparation(content_to_archive_list[0])
+        for i, content_to_archive in enumerate(content_to_archive_list):
+            preparator = pending[0].result()
+            if i + 1 < len(content_to_archive_list):
+                pending = submit_preparation(content_to_archive_list[i + 1])
+
+            _ask_archiving(content_to_archive, preparator.prepared_size(), ctx=ctx)
+            _upload_prepared(content_to_archive, preparator, ctx, swift)
+    except BaseException:
+        # Archiving is over, waiting for the preparation in flight would only delay the error
+        preparer.shutdown(wait=False, cancel_futures=True)
+        if pending is not None:
+            _abort_preparation(*pending)
+        raise
+    preparer.shutdown()
+
+
+def _abort_preparation(preparation: Future, preparator: PrepareContent):
+    """Stop preparation in flight, its file is released once the preparation ends"""
+    preparator.abort()
+    preparation.add_done_callback(lambda _: preparator.release())
+
+
 def process(args):
 
     with tempfile.TemporaryDirectory(dir=args.work_dir) as tmpdirname:
@@ -128,6 +324,8 @@ def process(args):
             container_name=args.container_name,
             temp_dir_name=tmpdirname,
             age_recipient=args.age_recipient,
+            compressed_data=args.compressed_data,
+            max_incremental_depth=args.max_incremental_depth,
             use_syslog=args.syslog,
             is_interactive=(sys.stdin.isatty() and sys.stderr.isatty()),
             dry_run=args.dry_run,
@@ -145,51 +343,56 @@ def process(args):
         if not ctx.is_interactive:
             _log.debug("Non-interactive mode")
 
-        _log.debug(f"Using storage container name {ctx.container_name}")
-        _log.debug(f"path: {ctx.path}")
-        _log.debug(f"Using working directory {ctx.temp_dir_name}")
+        _log.debug("Using storage container name %s", ctx.container_name)
+        _log.debug("path: %s", ctx.path)
+        _log.debug("Using working directory %s", ctx.temp_dir_name)
 
-        snapshots = [x for x in btrfs.find_ro_snapshots_of(ctx.path)]
+        snapshots = btrfs.find_ro_snapshots_of(ctx.path)
 
         if not snapshots:
             _log.info(f"No readonly snapshots exists for {ctx.path}")
             return
 
-        archived_snapshots = _look_for_archived_snapshots(snapshots, ctx)
-        content_to_archive_list = [
-            x for x in compute_snapshot_to_archive(snapshots, archived_snapshots)
-        ]
-
-        if not content_to_archive_list:
-            _log.info("Everything is already up to date.")
+        uploaded = _read_uploaded_index(snapshots[-1], ctx)
 
-        for content_to_archive in content_to_archive_list:
+        with swift_service() as swift:
+            # When every snapshot is confirmed, looking for archived ones requests nothing more,
+            # and their layout is still validated
+            known_stored = _confirm_uploaded(snapshots, uploaded, ctx, swift)
+            archived_snapshots = _look_for_archived_snapshots(
+                snapshots, ctx, swift, known_stored
+            )
+            archived_set = frozenset(archived_snapshots)
+            missing = uploaded.intersection(
+                compute_storage_filename(s) for s in snapshots if s not in archived_set
+            )
+            if missing:
+                _drop_uploaded(snapshots[-1], uploaded, missing, ctx)
+            content_to_archive_list = list(
+                compute_snapshot_to_archive(
+                    snapshots, archived_snapshots, ctx.max_incremental_depth
+                )
+            )
 
-            consent = _ask_preparing(content_to_archive, ctx=ctx)
-            if not consent:
-                _log.info("You refused, bybye")
+            if not content_to_archive_list:
+                _log.info("Everything is already up to date.")
                 return
 
-            filepath = _prepare_snapshot_to_archive(content_to_archive, ctx)
-            filesize = os.path.getsize(filepath)
-
-            if ctx.dry_run:
-                continue
+            if ctx.is_interactive or ctx.dry_run:
+                _archive_sequentially(content_to_archive_list, ctx, swift)
+            else:
+                _archive_pipelined(content_to_archive_list, ctx, swift)
 
-            consent = _ask_archiving(content_to_archive, filepath, ctx=ctx)
-            if not consent:
-                _log.info("You refused, bybye")
-                return
 
-            humanized_filesize = naturalsize(filesize)
-            msg_prefix = f" ⏳ Uploading {content_to_archive}."
-            with print_lines([f"{msg_prefix} This might take awhile."], ctx) as printer:
-                for transferred in upload(filepath, ctx.container_name):
-                    if ctx.is_interactive:
-                        msg = f"{msg_prefix}"
-                        msg += f" {naturalsize(transferred)}/{humanized_filesize}"
-                        printer.reprint([msg])
-                printer.reprint([f"Uploaded {content_to_archive} 💪"])
+def _non_negative_int(value: str) -> int:
+    """argparse type for counts, which can't be negative"""
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"should not be negative: '{value}'")
+    return count
 
 
 def main():
@@ -220,6 +423,19 @@ def main():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--compressed-data",
+        dest="compressed_data",
+        action="store_true",
+        help="Send compressed extents as is, using send stream protocol v2. Restoring requires btrfs-progs >= 5.19.",
+    )
+    parser.add_argument(
+        "--max-incremental-depth",
+        dest="max_incremental_depth",
+        type=_non_negative_int,
+        help="Upload a full snapshot instead of a difference after this many consecutive differences. Bounds the chain to replay on restore.",
+        default=None,
+    )
     parser.add_argument(
         "--syslog",
         dest="syslog",
@@ -1,20 +1,38 @@
 """
 storage module is about archive storage routines
 """
+import contextlib
+import functools
 import logging
 import os
-from typing import Sequence, Union
-
-from swiftclient.service import SwiftService, SwiftUploadObject
+import stat
+import time
+from typing import AbstractSet, Dict, List, Optional, Sequence, Set, Union
 
 from btrfs import Snapshot, SnapshotsDifference
 from exceptions import ProgrammingError
 from pprint import pformat
 
+# swiftclient (and its requests/keystone stack) is imported by the functions using it,
+# it is the bulk of the startup time of the command line
+
 _log = logging.getLogger(__name__)
 
 ContentToArchive = Union[Snapshot, SnapshotsDifference]
 
+_SEGMENT_THREADS = 10
+"""Number of segments of a large object uploaded concurrently"""
+_MIN_SEGMENT_SIZE = 64 * 1024 * 1024  # 64MiB
+_MAX_SEGMENT_SIZE = 1 * 1024 * 1024 * 1024  # 1GiB
+_MAX_SEGMENTS = 1000
+"""Default max_manifest_segments of swift static large objects"""
+_SERVICE_OPTIONS = {"retries": 0, "segment_threads": _SEGMENT_THREADS}
+"""Options of swift services, connections and thread pools are set up from those"""
+_EXACT_LISTING_MAX = 4
+"""Up to this many snapshots of a parent subvolume, storage is listed with each exact name as prefix"""
+_ATTEMPTS = 3
+"""Attempts of a storage request before giving up, waiting 2**attempt seconds in between"""
+
 
 class UploadFailure(RuntimeError):
     """Raised when upload fails"""
@@ -22,33 +40,87 @@ class UploadFailure(RuntimeError):
     pass
 
 
+def swift_service():
+    """
+    Create a swift service, to be used as a context manager.
+    Sharing it between calls of only_stored and upload reuses
+    its authenticated connections.
+    """
+    from swiftclient.service import SwiftService
+
+    return SwiftService(options=_SERVICE_OPTIONS)
+
+
+@contextlib.contextmanager
+def _swift_or_new(swift):
+    """Yield swift if provided, else a new service closed on exit"""
+    if swift is not None:
+        yield swift
+        return
+    with swift_service() as new_swift:
+        yield new_swift
+
+
+def _is_transient(e: Exception) -> bool:
+    """Is storage error worth a retry. Client errors (4xx) are not"""
+    cause = getattr(e, "exception", None) or e.__cause__ or e
+    status = getattr(cause, "http_status", None)
+    return status is None or status >= 500
+
+
+def _retryable_errors():
+    """Errors of storage requests which may be retried"""
+    from swiftclient.exceptions import ClientException
+    from swiftclient.service import SwiftError
+
+    return (SwiftError, ClientException, UploadFailure)
+
+
+def _should_retry(attempt: int, e: Exception) -> bool:
+    """Should failed attempt (0 based) be followed by another one"""
+    return attempt + 1 < _ATTEMPTS and _is_transient(e)
+
+
+def _wait_before_retry(attempt: int, e: Exception, what: str):
+    delay = 2**attempt
+    _log.warning("%s failed (%s), retrying in %ds", what, e, delay)
+    time.sleep(delay)
+
+
+def _compute_segment_size(size: int) -> int:
+    """
+    Compute segment size of a large object upload of 'size' bytes.
+    Segments are spread across upload threads, within storage limits.
+    """
+    segment_size = -(-size // _SEGMENT_THREADS)
+    segment_size = max(_MIN_SEGMENT_SIZE, min(_MAX_SEGMENT_SIZE, segment_size))
+    return max(segment_size, -(-size // _MAX_SEGMENTS))
+
+
 def _compute_common_prefix(str_list: list[str]):
     """Compute common prefix of a list of string"""
-    rest = ""
-    zipped = zip(*str_list)
-    for letters in zipped:
-        equals = all(letters[0] == letter for letter in letters)
-        if equals:
-            rest += letters[0]
-        else:
-            break
-    return rest
+    # commonprefix works character-wise, despite living in os.path
+    return os.path.commonprefix(str_list)
 
 
-def _parse_list_page_gen(list_parts_gen):
-    """Parse pages from list request"""
-    names = []
+def _parse_list_page_gen(list_parts_gen, wanted: Set[str]) -> Set[str]:
+    """
+    Parse pages from list request, page by page.
+    Returns:
+      the set of listed names which are wanted, other names are not kept
+    """
+    names = set()
     for page in list_parts_gen:
 
         if not page["success"]:
             raise page["error"]
 
-        for item in page["listing"]:
-            names.append(item["name"])
+        names.update(item["name"] for item in page["listing"] if item["name"] in wanted)
 
     return names
 
 
+@functools.lru_cache(maxsize=1024)
 def compute_storage_filename(to_archive: ContentToArchive) -> str:
     """
     Compute unique filename of a btrfs snapshot for storage.
@@ -80,73 +152,159 @@ def _sanitize_storage_filename(name: str):
     return name
 
 
+def _compute_list_prefixes(
+    ro_snapshots: Sequence[Snapshot], storage_filenames: Sequence[str]
+) -> Sequence[str]:
+    """
+    Compute prefixes to list storage with, one per parent subvolume.
+    Storage filenames start with parent uuid, so that listing never
+    goes beyond the objects of the parent subvolumes.
+    A few snapshots are rather listed by their own name, each of those
+    listings being a single small page.
+    """
+    by_parent: Dict[str, List[str]] = {}
+    for s, name in zip(ro_snapshots, storage_filenames):
+        by_parent.setdefault(s.parent_uuid, []).append(name)
+
+    prefixes = []
+    for names in by_parent.values():
+        if len(names) <= _EXACT_LISTING_MAX:
+            prefixes.extend(names)
+        else:
+            prefixes.append(_compute_common_prefix(names))
+    return prefixes
+
+
+def _list_names(swift, container_name: str, prefix: str, wanted: Set[str]) -> Set[str]:
+    """Wanted names of objects in container starting with prefix"""
+    for attempt in range(_ATTEMPTS):
+        try:
+            list_page_gen = swift.list(
+                container=container_name, options={"prefix": prefix}
+            )
+            return _parse_list_page_gen(list_page_gen, wanted)
+        except _retryable_errors() as e:
+            if not _should_retry(attempt, e):
+                raise
+            _wait_before_retry(attempt, e, f"Listing of {container_name}")
+    raise ProgrammingError
+
+
 def only_stored(
-    ro_snapshots: Sequence[Snapshot], container_name: str
+    ro_snapshots: Sequence[Snapshot],
+    container_name: str,
+    swift=None,
+    known_stored: AbstractSet[str] = frozenset(),
 ) -> Sequence[Snapshot]:
     """
     Args:
       ro_snapshots(Sequence[Snapshot]): snapshots to check against storage
+      swift: swift service to use, see swift_service(). A new one is used if not provided
+      known_stored: storage filenames known to be stored, storage is only requested for other snapshots
 
     Returns:
       Filtered list of btrfs snapshots, conserving only the ones present in storage
     """
     storage_filename_of_snapshots = [compute_storage_filename(s) for s in ro_snapshots]
-    prefix = _compute_common_prefix(storage_filename_of_snapshots)
-    _log.debug(f'Search storage for files with prefix "{prefix}"')
+    unknown = [
+        (s, name)
+        for s, name in zip(ro_snapshots, storage_filename_of_snapshots)
+        if name not in known_stored
+    ]
+    _log.debug("%d snapshots are known to be stored.", len(ro_snapshots) - len(unknown))
 
-    container_item_names = []
-    with SwiftService() as swift:
-        list_page_gen = swift.list(container=container_name, options={"prefix": prefix})
-        container_item_names = _parse_list_page_gen(list_page_gen)
+    container_item_names: Set[str] = set()
+    if unknown:
+        unknown_snapshots = [s for s, _ in unknown]
+        unknown_names = [name for _, name in unknown]
+        wanted = set(unknown_names)
+        with _swift_or_new(swift) as swift:
+            for prefix in _compute_list_prefixes(unknown_snapshots, unknown_names):
+                _log.debug('Search storage for files with prefix "%s"', prefix)
+                container_item_names |= _list_names(
+                    swift, container_name, prefix, wanted
+                )
 
-    _log.debug(f"Found {len(container_item_names)} files.")
+    _log.debug("Found %d files named after snapshots.", len(container_item_names))
     result = [
-        s for s in ro_snapshots if compute_storage_filename(s) in container_item_names
+        s
+        for s, name in zip(ro_snapshots, storage_filename_of_snapshots)
+        if name in known_stored or name in container_item_names
     ]
     _log.debug(
-        f"Filtering... Found {len(result)} files corresponding to actual snapshots."
+        "Filtering... Found %d files corresponding to actual snapshots.", len(result)
     )
     return result
 
 
-def upload(filepath: str, container_name: str):
+def upload(
+    filepath: str, container_name: str, filesize: Optional[int] = None, swift=None
+):
     """
     Uploads file to container
+    Args:
+      filesize: size of the file, if already known by caller
+      swift: swift service to use, see swift_service(). A new one is used if not provided
     Returns:
       Generator on progress. yield number of bytes transfered after each segment is transfered.
+      Transient failures are retried, progress then restarts from 0 with the new attempt.
     Raises:
       UploadFailure
     """
     filep = os.path.abspath(filepath)
-    if not os.path.isfile(filep):
+    try:
+        st = os.stat(filep)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
         raise ValueError(f"{filep} is not a file")
 
-    _segment_size = int(1 * 1024 * 1024 * 1024)  # 1GiB
     _opts = {
-        "retries": 0,
-        "segment_size": _segment_size,
+        "segment_size": _compute_segment_size(
+            filesize if filesize is not None else st.st_size
+        ),
         "use_slo": True,
     }
 
-    _log.debug(f"Swift options: {_opts}")
-    with SwiftService(options=_opts) as swift:
-        # Contrary to what is stated in the documentation, upload creates container when it does not exist.
-        # In order to fail fast, we stat the container, which raises SwiftError in case of non existing one
-        swift.stat(container=container_name)
+    _log.debug("Swift upload options: %s", _opts)
+    with _swift_or_new(swift) as swift:
+        for attempt in range(_ATTEMPTS):
+            try:
+                yield from _upload_once(swift, filep, container_name, _opts)
+                return
+            except _retryable_errors() as e:
+                if not _should_retry(attempt, e):
+                    raise
+                _wait_before_retry(attempt, e, f"Upload of {filep}")
+
+
+def _upload_once(swift, filep: str, container_name: str, options):
+    """Single attempt of upload, see upload()"""
+    from swiftclient.service import SwiftUploadObject
 
-        upload = SwiftUploadObject(source=filep, object_name=os.path.basename(filep))
-        _log.debug(f"Uploading {upload}")
+    # Contrary to what is stated in the documentation, upload creates container when it does not exist.
+    # In order to fail fast, we stat the container, which raises SwiftError in case of non existing one
+    swift.stat(container=container_name)
 
-        will_fail = True
-        transfered = 0
-        yield transfered
-        for r in swift.upload(container=container_name, objects=[upload]):
+    upload = SwiftUploadObject(source=filep, object_name=os.path.basename(filep))
+    _log.debug("Uploading %s", upload)
+
+    will_fail = True
+    error = None
+    transfered = 0
+    yield transfered
+    for r in swift.upload(container=container_name, objects=[upload], options=options):
+        if _log.isEnabledFor(logging.DEBUG):
             _log.debug(pformat(r))
-            if r["success"] and r["action"] == "upload_object":
-                will_fail = False
-            if r["success"] and r["action"] == "upload_segment":
-                transfered += r["segment_size"]
-                yield transfered
-
-        if will_fail:
-            raise UploadFailure(f"Failed to upload {filep}")
+        if not r["success"]:
+            # Failures are reported as results, the first one carries the cause
+            error = error or r.get("error")
+            _log.warning(f"Upload of {filep} failed on {r.get('action')}: {r.get('error')}")
+        elif r["action"] == "upload_object":
+            will_fail = False
+        elif r["action"] == "upload_segment":
+            transfered += r["segment_size"]
+            yield transfered
+
+    if will_fail:
+        raise UploadFailure(f"Failed to upload {filep}") from error
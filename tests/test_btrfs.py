@@ -1,13 +1,27 @@
 import os
+import random
 from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Hashable
 from unittest.mock import MagicMock, patch
 import uuid
 
-from btrfs import Snapshot, find_ro_snapshots_of
+import pytest
 
+from btrfs import Snapshot, find_ro_snapshots_of, _compute_root_path, _cached_uuid
 
+
+@pytest.fixture(scope="module", params=["/fs", "/"])
+def fs_path(request) -> str:
+    return request.param
+
+
+@pytest.fixture(scope="module")
+def model(fs_path: str) -> "_TestModel":
+    return _make_model(fs_path)
+
+
+@pytest.mark.parametrize("serial_probe_max", [16, 0], ids=["serial", "pooled"])
 @patch("btrfsutil.SubvolumeIterator")
 @patch("btrfsutil.get_subvolume_read_only")
 @patch("btrfsutil.subvolume_info")
@@ -17,30 +31,34 @@ def test_find_ro_snapshots_of(
     mock_subvolume_info: MagicMock,
     mock_get_subvolume_readonly: MagicMock,
     mock_subvolume_iterator: MagicMock,
+    serial_probe_max: int,
+    fs_path: str,
+    model: "_TestModel",
+    monkeypatch,
 ):
-    def test_with_model(fs_path):
-        model = _make_model(fs_path)
-
-        mock_subvolume_info.side_effect = _subvolume_info(model.subvols())
-        mock_subvolume_path.side_effect = _subvolume_path(model.subvols())
-        mock_get_subvolume_readonly.side_effect = _get_subvolume_read_only(
-            model.subvols()
-        )
-        mock_subvolume_iterator.side_effect = _subvolume_iterator(model.subvols())
-
-        snapshots = find_ro_snapshots_of(os.path.join(fs_path, "subvol"))
-        assert len(snapshots) == 3
-        assert snapshots[0].rel_path == "snapshots/subvol.0"
-        assert snapshots[1].rel_path == "snapshots/subvol.1"
-        assert snapshots[2].rel_path == "snapshots/subvol.2"
-
-        for snapshot in snapshots:
-            model_subvol = model.subvol(snapshot.rel_path)
-            parent_uuid_str = str(uuid.UUID(bytes=model_subvol.parent_uuid))
-            assert snapshot.parent_uuid == parent_uuid_str
-
-    test_with_model("/fs")
-    test_with_model("/")
+    monkeypatch.setattr("btrfs._SERIAL_PROBE_MAX", serial_probe_max)
+    _compute_root_path.cache_clear()
+    _cached_uuid.cache_clear()
+
+    mock_subvolume_info.side_effect = _subvolume_info(model.subvols())
+    mock_subvolume_path.side_effect = _subvolume_path(model.subvols())
+    mock_get_subvolume_readonly.side_effect = _get_subvolume_read_only(
+        model.subvols()
+    )
+    mock_subvolume_iterator.side_effect = _subvolume_iterator(model.subvols())
+
+    snapshots = find_ro_snapshots_of(os.path.join(fs_path, "subvol"))
+    # Only snapshots of the subvolume are probed for read only
+    assert mock_get_subvolume_readonly.call_count == 4
+    assert len(snapshots) == 3
+    assert snapshots[0].rel_path == "snapshots/subvol.0"
+    assert snapshots[1].rel_path == "snapshots/subvol.1"
+    assert snapshots[2].rel_path == "snapshots/subvol.2"
+
+    for snapshot in snapshots:
+        model_subvol = model.subvol(snapshot.rel_path)
+        parent_uuid_str = str(uuid.UUID(bytes=model_subvol.parent_uuid))
+        assert snapshot.parent_uuid == parent_uuid_str
 
 
 def test_snapshot_is_hashable():
@@ -58,13 +76,18 @@ def test_shapshot_uuid():
 @dataclass
 class _FakeSubvol:
     """Information holder for faking btrfsutil calls"""
+
+    # Explicit __slots__ rather than dataclass(slots=True), which requires python 3.10.
+    # Slots cannot have class level defaults, every field is passed explicitly.
+    __slots__ = ("relpath", "abspath", "id", "uuid", "parent_uuid", "ro", "otime")
+
     relpath: str
     abspath: str
     id: int
     uuid: bytes
     parent_uuid: bytes
-    ro: bool = False
-    otime: float = 0.0
+    ro: bool
+    otime: float
 
     def uuid_as_str(self):
         return str(uuid.UUID(bytes=self.uuid))
@@ -72,44 +95,44 @@ class _FakeSubvol:
 
 def _subvolume_info(model: list[_FakeSubvol]):
     """Generate mocked version of btrfs.subvolume_info(path, <id>)"""
+    by_id = {x.id: x for x in model}
+    by_abspath = {x.abspath: x for x in model}
 
     def inner(path, id_=0):
-        if id_ > 0:
-            return next(x for x in model if id_ == x.id)
-        else:
-            return next(x for x in model if path == x.abspath)
+        return by_id[id_] if id_ > 0 else by_abspath[path]
 
     return inner
 
 
 def _subvolume_path(model: list[_FakeSubvol]):
     """Generate mocked version of btrfs.subvolume_path(path, <id>)"""
-
-    def inner(fullpath):
-        return next(x.relpath for x in model if x.abspath == fullpath)
-
-    return inner
+    return {x.abspath: x.relpath for x in model}.__getitem__
 
 
 def _get_subvolume_read_only(model: list[_FakeSubvol]):
     """Generate mocked version of btrfs.get_subvolume_read_only(path)"""
+    by_abspath = {os.path.normpath(x.abspath): x for x in model}
 
     def inner(fullpath: str):
-        fullpath = os.path.normpath(fullpath)
-        return next(x.ro for x in model if x.abspath == fullpath)
+        try:
+            return by_abspath[fullpath].ro
+        except KeyError:
+            return by_abspath[os.path.normpath(fullpath)].ro
 
     return inner
 
 
 def _subvolume_iterator(model: list[_FakeSubvol]):
     """Generate mocked version of btrfs.SubvolumeIterator"""
+    # Since we expect listing subvol from rootfs, we list all
+    with_info = [(x.relpath, x) for x in model]
+    with_id = [(x.relpath, x.id) for x in model]
 
     @contextmanager
-    def inner(*args):
+    def inner(*args, info=False):
         if len(args) != 2 or args[1] != 5:
             raise ValueError("Only supports call with (path, 5)")
-        # Since we expect listing subvol from rootfs, we list all
-        yield list((x.relpath, x.id) for x in model)
+        yield list(with_info if info else with_id)
 
     return inner
 
@@ -117,10 +140,11 @@ def _subvolume_iterator(model: list[_FakeSubvol]):
 class _TestModel:
     def __init__(self, model: list[_FakeSubvol]) -> None:
         self._model = model
+        self._by_relpath = {s.relpath: s for s in reversed(model)}
 
     def subvol(self, relpath: str) -> _FakeSubvol:
         """Finds first subvol in test model having specified relpath"""
-        return next(s for s in self._model if s.relpath == relpath)
+        return self._by_relpath[relpath]
 
     def subvols(self) -> tuple[_FakeSubvol, ...]:
         return tuple(self._model)
@@ -130,17 +154,20 @@ def _make_model(rootfs: str) -> _TestModel:
     """Quick and dirty model for a btrfs subvolume tree"""
     rootfs = rootfs if rootfs == "/" else rootfs.removesuffix("/")
     prefix_rootfs = rootfs if rootfs[-1] == "/" else rootfs + "/"
-    rootfs_uuid = uuid.uuid4().bytes
+    rng = random.Random(0x5EED)  # deterministic uuids, across runs
+    rootfs_uuid = rng.randbytes(16)
 
-    subvol_uuid = uuid.uuid4().bytes
-    subvol_1_uuid = uuid.uuid4().bytes
+    subvol_uuid = rng.randbytes(16)
+    subvol_1_uuid = rng.randbytes(16)
     subvols = [
         _FakeSubvol(
             relpath="",
             abspath=f"{rootfs}",
             id=5,
-            uuid=uuid.uuid4().bytes,
+            uuid=rng.randbytes(16),
             parent_uuid=b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00",
+            ro=False,
+            otime=0.0,
         ),
         _FakeSubvol(
             relpath="subvol",
@@ -148,6 +175,8 @@ def _make_model(rootfs: str) -> _TestModel:
             id=6,
             uuid=subvol_uuid,
             parent_uuid=rootfs_uuid,
+            ro=False,
+            otime=0.0,
         ),
         _FakeSubvol(
             relpath="snapshots/subvol.1",
@@ -162,7 +191,7 @@ def _make_model(rootfs: str) -> _TestModel:
             relpath="snapshots/subvol.2",
             abspath=f"{prefix_rootfs}snapshots/subvol.2",
             id=8,
-            uuid=uuid.uuid4().bytes,
+            uuid=rng.randbytes(16),
             parent_uuid=subvol_uuid,
             ro=True,
             otime=2.0,
@@ -171,7 +200,7 @@ def _make_model(rootfs: str) -> _TestModel:
             relpath="snapshots/subvol.0",
             abspath=f"{prefix_rootfs}snapshots/subvol.0",
             id=11,
-            uuid=uuid.uuid4().bytes,
+            uuid=rng.randbytes(16),
             parent_uuid=subvol_uuid,
             ro=True,
             otime=0.0,
@@ -180,15 +209,19 @@ def _make_model(rootfs: str) -> _TestModel:
             relpath="snapshots/subvol.3",
             abspath=f"{prefix_rootfs}snapshots/subvol.3",
             id=10,
-            uuid=uuid.uuid4().bytes,
+            uuid=rng.randbytes(16),
             parent_uuid=subvol_uuid,
+            ro=False,
+            otime=0.0,
         ),
         _FakeSubvol(
             relpath="snapshots/subvol.1.1",
             abspath=f"{prefix_rootfs}snapshots/subvol.1.1",
             id=1,
-            uuid=uuid.uuid4().bytes,
+            uuid=rng.randbytes(16),
             parent_uuid=subvol_1_uuid,
+            ro=False,
+            otime=0.0,
         ),
     ]
     return _TestModel(subvols)
@@ -1,3 +1,6 @@
+import functools
+from typing import Tuple
+
 from btrfs import Snapshot
 
 import pytest
@@ -12,45 +15,44 @@ from business import UnexpectedSnapshotStorageLayout
 _static_uuids = tuple(u() for u in repeat(uuid4, 10))
 
 
-def _snapshot_gen():
-    yield Snapshot(
-        parent_uuid=_static_uuids[0],
-        rel_path="/snapshots/1",
-        abs_path="/fs/snapshots/1",
-        otime=0.0,
-    )
-    yield Snapshot(
-        parent_uuid=_static_uuids[1],
-        rel_path="/snapshots/2",
-        abs_path="/fs/snapshots/2",
-        otime=1.0,
-    )
-    yield Snapshot(
-        parent_uuid=_static_uuids[2],
-        rel_path="/snapshots/3",
-        abs_path="/fs/snapshots/3",
-        otime=2.0,
-    )
-    yield Snapshot(
-        parent_uuid=_static_uuids[3],
-        rel_path="/snapshots/4",
-        abs_path="/fs/snapshots/4",
-        otime=3.0,
+@functools.lru_cache(maxsize=1)
+def _snapshots() -> Tuple[Snapshot, ...]:
+    """The four test snapshots, ordered by otime"""
+    return (
+        Snapshot(
+            parent_uuid=_static_uuids[0],
+            rel_path="/snapshots/1",
+            abs_path="/fs/snapshots/1",
+            otime=0.0,
+        ),
+        Snapshot(
+            parent_uuid=_static_uuids[1],
+            rel_path="/snapshots/2",
+            abs_path="/fs/snapshots/2",
+            otime=1.0,
+        ),
+        Snapshot(
+            parent_uuid=_static_uuids[2],
+            rel_path="/snapshots/3",
+            abs_path="/fs/snapshots/3",
+            otime=2.0,
+        ),
+        Snapshot(
+            parent_uuid=_static_uuids[3],
+            rel_path="/snapshots/4",
+            abs_path="/fs/snapshots/4",
+            otime=3.0,
+        ),
     )
 
 
 @pytest.mark.parametrize(
     "snapshots,archived",
     [
-        (
-            [s for s in _snapshot_gen()],
-            [s for (i, s) in enumerate(_snapshot_gen()) if i > 0],
-        ),
-        (
-            [s for s in _snapshot_gen()],
-            [s for (i, s) in enumerate(_snapshot_gen()) if i > 1],
-        ),
+        (_snapshots(), _snapshots()[1:]),
+        (_snapshots(), _snapshots()[2:]),
     ],
+    ids=["first_not_archived", "first_two_not_archived"],
 )
 def test_compute_snapshots_to_archive_unexpected_storage_layout(snapshots, archived):
     with pytest.raises(UnexpectedSnapshotStorageLayout):
@@ -60,12 +62,13 @@ def test_compute_snapshots_to_archive_unexpected_storage_layout(snapshots, archi
 @pytest.mark.parametrize(
     "snapshots,archived",
     [
-        ([next(_snapshot_gen()), next(_snapshot_gen())], []),  # Same snapshots
+        ((_snapshots()[0], _snapshots()[0]), ()),  # Same snapshots
         (
-            [next(_snapshot_gen()), next(_snapshot_gen())],  # Same snapshots
-            [next(_snapshot_gen())],
+            (_snapshots()[0], _snapshots()[0]),  # Same snapshots
+            (_snapshots()[0],),
         ),
     ],
+    ids=["duplicates_empty_archive", "duplicates_one_archived"],
 )
 def test_compute_snapshots_to_archive_value_error(snapshots, archived):
     with pytest.raises(ValueError):
@@ -75,15 +78,10 @@ def test_compute_snapshots_to_archive_value_error(snapshots, archived):
 @pytest.mark.parametrize(
     "snapshots,archived",
     [
-        (
-            [s for s in _snapshot_gen()],
-            [s for s in _snapshot_gen()],
-        ),
-        (
-            [s for s in _snapshot_gen()],
-            [s for (i, s) in enumerate(_snapshot_gen()) if i < 2],
-        ),
+        (_snapshots(), _snapshots()),
+        (_snapshots(), _snapshots()[:2]),
     ],
+    ids=["all_archived", "first_two_archived"],
 )
 def test_compute_snapshots_to_archive_no_exception(snapshots, archived):
     compute_snapshot_to_archive(snapshots, archived)
@@ -94,7 +92,8 @@ def test_compute_snapshots_to_archive():
         next(compute_snapshot_to_archive([], []))
 
     n_snapshots = 3
-    snapshots = tuple(s for (i, s) in enumerate(_snapshot_gen()) if i < n_snapshots)
+    snaps = _snapshots()
+    snapshots = snaps[:n_snapshots]
 
     archived = ()
     to_be_uploaded = [x for x in compute_snapshot_to_archive(snapshots, archived)]
@@ -102,7 +101,7 @@ def test_compute_snapshots_to_archive():
     assert isinstance(to_be_uploaded[0], Snapshot)
     assert isinstance(to_be_uploaded[1], SnapshotsDifference)
 
-    archived = tuple(s for (i, s) in enumerate(snapshots) if i < 2)
+    archived = snaps[:2]
     to_be_uploaded = [x for x in compute_snapshot_to_archive(snapshots, archived)]
     assert len(to_be_uploaded) == 1
     assert isinstance(to_be_uploaded[0], SnapshotsDifference)
@@ -112,11 +111,40 @@ def test_compute_snapshots_to_archive():
     assert not to_be_uploaded
 
 
+def test_compute_snapshots_to_archive_max_incremental_depth():
+    snapshots = _snapshots()
+
+    to_be_uploaded = [
+        x for x in compute_snapshot_to_archive(snapshots, (), max_incremental_depth=1)
+    ]
+    assert [type(x) for x in to_be_uploaded] == [
+        Snapshot,
+        SnapshotsDifference,
+        Snapshot,
+        SnapshotsDifference,
+    ]
+
+    archived = snapshots[:2]
+    to_be_uploaded = [
+        x
+        for x in compute_snapshot_to_archive(
+            snapshots, archived, max_incremental_depth=1
+        )
+    ]
+    assert to_be_uploaded == [
+        snapshots[2],
+        SnapshotsDifference(snapshots[2], snapshots[3]),
+    ]
+
+    with pytest.raises(ValueError):
+        next(compute_snapshot_to_archive(snapshots, (), max_incremental_depth=-1))
+
+
 def test_prepare_content():
 
     """Test initialization of PrepareContent."""
     with TemporaryDirectory() as tmpdirname:
-        snapshot = next(_snapshot_gen())
+        snapshot = _snapshots()[0]
         preparator = PrepareContent(snapshot, tmpdirname, None)
         assert preparator.target_path() is not None
 
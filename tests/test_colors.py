@@ -1,11 +1,21 @@
+import os
 import pytest
 from ansi import colors as C
 
 
 def test_colors():
-    print(f"{C.red}red{C.reset}")
-    print(f"{C.red}Hel{C.bright_red}lo {C.yellow}world{C.reset}")
-    print(f"This is {C.color256(1)}256 colors{C.reset}")
+    samples = [
+        f"{C.red}red{C.reset}",
+        f"{C.red}Hel{C.bright_red}lo {C.yellow}world{C.reset}",
+        f"This is {C.color256(1)}256 colors{C.reset}",
+    ]
+    assert samples[0] == "\x1b[31mred\x1b[0m"
+    assert all(s.endswith(C.reset) for s in samples)
+    assert C.bright_red in samples[1] and C.yellow in samples[1]
+    assert C.color256(1) in samples[2]
+
+    if os.environ.get("SHOW_COLORS"):  # visual check
+        print("\n".join(samples))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,314 @@
+import argparse
+import contextlib
+import os
+import stat
+import threading
+import time
+from typing import Dict, Tuple
+
+import pytest
+
+from _main_commons import Ctx
+from btrfs import Snapshot, SnapshotsDifference
+from business import UnexpectedSnapshotStorageLayout
+from main import (
+    _archive_pipelined,
+    _non_negative_int,
+    _read_uploaded_index,
+    _record_uploaded,
+    _uploaded_index_name,
+    process,
+)
+from storage import UploadFailure, compute_storage_filename
+
+
+@pytest.mark.parametrize("value, expected", [("0", 0), ("3", 3)])
+def test_non_negative_int(value, expected):
+    assert _non_negative_int(value) == expected
+
+
+@pytest.mark.parametrize("value", ["-1", "two", ""])
+def test_non_negative_int_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        _non_negative_int(value)
+
+
+def test_non_negative_int_parse_error(capsys):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=_non_negative_int)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--depth", "-1"])
+    assert "should not be negative" in capsys.readouterr().err
+
+
+class _FakePreparator:
+    """Preparation which only completes once 'done' is set, or gets aborted"""
+
+    __slots__ = ("content", "done", "aborted", "released")
+
+    def __init__(self, content):
+        self.content = content
+        self.done = threading.Event()
+        self.aborted = False
+        self.released = False
+
+    def prepare(self):
+        if not self.done.wait(timeout=5):
+            raise TimeoutError(f"{self.content} never completed")
+        if self.aborted:
+            raise RuntimeError(f"{self.content} was aborted")
+
+    def abort(self):
+        self.aborted = True
+        self.done.set()
+
+    def release(self):
+        self.released = True
+
+    def prepared_size(self) -> int:
+        return 0
+
+
+def _ctx(tmp_path) -> Ctx:
+    return Ctx(
+        path="/fs/subvol",
+        verbose=False,
+        container_name="container",
+        temp_dir_name=str(tmp_path),
+        age_recipient="",
+        compressed_data=False,
+        max_incremental_depth=None,
+        use_syslog=False,
+        is_interactive=False,
+        dry_run=False,
+    )
+
+
+@pytest.fixture
+def preparators(monkeypatch) -> Dict[str, _FakePreparator]:
+    preparators: Dict[str, _FakePreparator] = {}
+
+    def new_preparator(content, ctx):
+        return preparators.setdefault(content, _FakePreparator(content))
+
+    def prepare(preparator, ctx):
+        preparator.prepare()
+        return preparator
+
+    monkeypatch.setattr("main._new_preparator", new_preparator)
+    monkeypatch.setattr("main._prepare_snapshot_to_archive", prepare)
+    return preparators
+
+
+def test_archive_pipelined(tmp_path, preparators, monkeypatch):
+    uploaded = []
+
+    def upload_prepared(content, preparator, ctx, swift):
+        uploaded.append(content)
+        # Next content is being prepared meanwhile, and completes during upload
+        following = preparators.get(chr(ord(content) + 1))
+        assert following is not None or content == "c"
+        if following is not None:
+            following.done.set()
+
+    monkeypatch.setattr("main._upload_prepared", upload_prepared)
+
+    first = _FakePreparator("a")
+    first.done.set()
+    preparators["a"] = first
+    _archive_pipelined(["a", "b", "c"], _ctx(tmp_path), swift=None)
+
+    assert uploaded == ["a", "b", "c"]
+    assert not any(p.aborted for p in preparators.values())
+
+
+def test_archive_pipelined_upload_failure(tmp_path, preparators, monkeypatch):
+    def upload_prepared(content, preparator, ctx, swift):
+        raise UploadFailure(f"{content} failed")
+
+    monkeypatch.setattr("main._upload_prepared", upload_prepared)
+
+    first = _FakePreparator("a")
+    first.done.set()
+    preparators["a"] = first
+    with pytest.raises(UploadFailure):
+        _archive_pipelined(["a", "b", "c"], _ctx(tmp_path), swift=None)
+
+    # Preparation in flight is aborted rather than awaited, then released
+    pending = preparators["b"]
+    assert pending.aborted
+    for _ in range(50):
+        if pending.released:
+            break
+        time.sleep(0.01)
+    assert pending.released
+    assert "c" not in preparators
+
+
+def _snapshot(n: int) -> Snapshot:
+    return Snapshot(
+        parent_uuid="puuid",
+        rel_path=f"snapshots/{n}",
+        abs_path=f"/fs/snapshots/{n}",
+        otime=float(n),
+    )
+
+
+@pytest.fixture
+def cache_home(tmp_path, monkeypatch) -> str:
+    cache_home = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_home))
+    return str(cache_home)
+
+
+def test_uploaded_index(tmp_path, cache_home):
+    ctx = _ctx(tmp_path)
+    s1, s2 = _snapshot(1), _snapshot(2)
+    assert _read_uploaded_index(s1, ctx) == frozenset()
+
+    _record_uploaded(s1, ctx)
+    diff = SnapshotsDifference(s1, s2)
+    _record_uploaded(diff, ctx)
+    expected = {compute_storage_filename(s1), compute_storage_filename(diff)}
+    assert _read_uploaded_index(s2, ctx) == expected
+
+    index_dir = os.path.join(cache_home, "btrfs-to-swift")
+    assert stat.S_IMODE(os.stat(index_dir).st_mode) == 0o700
+    (index,) = os.listdir(index_dir)
+    assert stat.S_IMODE(os.stat(os.path.join(index_dir, index)).st_mode) == 0o600
+
+
+def test_uploaded_index_does_not_follow_symlinks(tmp_path, cache_home):
+    ctx = _ctx(tmp_path)
+    s = _snapshot(1)
+    target = tmp_path / "target"
+    target.write_text(compute_storage_filename(s) + "\n")
+    index_dir = os.path.join(cache_home, "btrfs-to-swift")
+    os.makedirs(index_dir, mode=0o700)
+    os.symlink(target, os.path.join(index_dir, _uploaded_index_name(s, ctx)))
+
+    assert _read_uploaded_index(s, ctx) == frozenset()
+    _record_uploaded(_snapshot(2), ctx)
+    assert target.read_text() == compute_storage_filename(s) + "\n"
+
+
+def test_uploaded_index_untrusted_dir(tmp_path, cache_home):
+    ctx = _ctx(tmp_path)
+    s = _snapshot(1)
+    index_dir = os.path.join(cache_home, "btrfs-to-swift")
+    os.makedirs(index_dir)
+    os.chmod(index_dir, 0o777)
+
+    _record_uploaded(s, ctx)
+    assert os.listdir(index_dir) == []
+    assert _read_uploaded_index(s, ctx) == frozenset()
+
+
+class _FakeStorage:
+    """Storage holding 'stored' snapshots, recording names it was asked for"""
+
+    def __init__(self, stored):
+        self.stored = frozenset(stored)
+        self.requested = []
+
+    def only_stored(self, ro_snapshots, container_name, swift=None, known_stored=frozenset()):
+        known = [s for s in ro_snapshots if compute_storage_filename(s) in known_stored]
+        asked = [s.rel_path for s in ro_snapshots if s not in known]
+        if asked:
+            self.requested.append(asked)
+        return [s for s in ro_snapshots if s in self.stored or s in known]
+
+
+@pytest.fixture
+def process_args(tmp_path, cache_home, monkeypatch) -> argparse.Namespace:
+    snapshots = [_snapshot(1), _snapshot(2)]
+    monkeypatch.setattr("btrfs.find_ro_snapshots_of", lambda path: snapshots)
+    monkeypatch.setattr("main.swift_service", contextlib.nullcontext)
+    monkeypatch.setattr("main._configure_logging", lambda ctx: None)
+    return argparse.Namespace(
+        path="/fs/subvol",
+        verbose=False,
+        container_name="container",
+        work_dir=str(tmp_path),
+        age_recipient="",
+        compressed_data=False,
+        max_incremental_depth=None,
+        syslog=False,
+        dry_run=False,
+    )
+
+
+def _use_storage(monkeypatch, stored) -> Tuple[_FakeStorage, list]:
+    storage = _FakeStorage(stored)
+    archiving = []
+    monkeypatch.setattr("main.only_stored", storage.only_stored)
+    archive = lambda contents, ctx, swift: archiving.extend(contents)
+    monkeypatch.setattr("main._archive_pipelined", archive)
+    monkeypatch.setattr("main._archive_sequentially", archive)
+    return storage, archiving
+
+
+def test_process_recorded_and_stored(tmp_path, process_args, monkeypatch):
+    ctx = _ctx(tmp_path)
+    storage, archiving = _use_storage(monkeypatch, [_snapshot(1), _snapshot(2)])
+    _record_uploaded(_snapshot(1), ctx)
+    _record_uploaded(_snapshot(2), ctx)
+
+    process(process_args)
+
+    # Only the newest recorded snapshot is checked against storage
+    assert storage.requested == [["snapshots/2"]]
+    assert archiving == []
+
+
+def test_process_recorded_but_not_stored(tmp_path, process_args, monkeypatch):
+    ctx = _ctx(tmp_path)
+    storage, archiving = _use_storage(monkeypatch, [_snapshot(1)])
+    _record_uploaded(_snapshot(1), ctx)
+    _record_uploaded(_snapshot(2), ctx)
+
+    process(process_args)
+
+    # Index can't be trusted anymore, every snapshot is checked
+    assert storage.requested == [["snapshots/2"], ["snapshots/1", "snapshots/2"]]
+    assert archiving == [SnapshotsDifference(_snapshot(1), _snapshot(2))]
+    assert _read_uploaded_index(_snapshot(2), ctx) == {
+        compute_storage_filename(_snapshot(1))
+    }
+
+
+def test_process_recorded_parent_stored(tmp_path, process_args, monkeypatch):
+    ctx = _ctx(tmp_path)
+    storage, archiving = _use_storage(monkeypatch, [_snapshot(1)])
+    _record_uploaded(_snapshot(1), ctx)
+
+    process(process_args)
+
+    # Parent of the difference is confirmed, other recorded snapshots are not requested
+    assert storage.requested == [["snapshots/1"], ["snapshots/2"]]
+    assert archiving == [SnapshotsDifference(_snapshot(1), _snapshot(2))]
+
+
+def test_process_recorded_parent_missing(tmp_path, process_args, monkeypatch):
+    ctx = _ctx(tmp_path)
+    storage, archiving = _use_storage(monkeypatch, [])
+    _record_uploaded(_snapshot(1), ctx)
+
+    process(process_args)
+
+    # Storage was emptied, everything is uploaded again starting with a full snapshot
+    assert storage.requested == [["snapshots/1"], ["snapshots/1", "snapshots/2"]]
+    assert archiving == [_snapshot(1), SnapshotsDifference(_snapshot(1), _snapshot(2))]
+    assert _read_uploaded_index(_snapshot(2), ctx) == frozenset()
+
+
+def test_process_unrecorded_snapshot_missing(tmp_path, process_args, monkeypatch):
+    ctx = _ctx(tmp_path)
+    storage, archiving = _use_storage(monkeypatch, [_snapshot(2)])
+    _record_uploaded(_snapshot(2), ctx)
+
+    # Newest snapshot is recorded, layout is still validated
+    with pytest.raises(UnexpectedSnapshotStorageLayout):
+        process(process_args)
+    assert storage.requested == [["snapshots/2"], ["snapshots/1"]]
+    assert archiving == []
@@ -67,13 +67,7 @@ def test_lines_printer():
 
     def loading_bar(n):
         width = 10
-        acc = "["
-        for _ in range(n):
-            acc += "="
-        for _ in range(width - n):
-            acc += " "
-        acc += "]"
-        return acc
+        return "[" + "=" * n + " " * (width - n) + "]"
 
     def loading_bars(n, j):
         return [loading_bar(n) for _ in range(j)]
@@ -1,19 +1,23 @@
 from unittest.mock import MagicMock, patch
 
+import itertools
 import uuid
 import pytest
 
-from swiftclient.service import SwiftService
 from btrfs import Snapshot
 from storage import (
     _compute_common_prefix,
+    _compute_list_prefixes,
+    _compute_segment_size,
     compute_storage_filename,
     _sanitize_storage_filename,
     only_stored,
+    upload,
+    UploadFailure,
 )
 
 
-@patch("test_storage.SwiftService.list")
+@patch("swiftclient.service.SwiftService.list")
 def test_only_stored(listMock: MagicMock):
     snapshots = _make_btrfs_snapshots("snap/one", "snap/two")
     _configure_list_mock(
@@ -26,6 +30,113 @@ def test_only_stored(listMock: MagicMock):
     assert stored_snapshots == snapshots[0:1]
 
 
+@patch("swiftclient.service.SwiftService.list")
+def test_only_stored_known_stored(listMock: MagicMock):
+    snapshots = _make_btrfs_snapshots("snap/one", "snap/two")
+    known = {compute_storage_filename(snapshots[0])}
+    _configure_list_mock(listMock, compute_storage_filename(snapshots[1]))
+
+    stored_snapshots = only_stored(snapshots, "whatever", known_stored=known)
+
+    assert stored_snapshots == snapshots
+    listMock.assert_called_once()
+    assert listMock.call_args.kwargs["options"]["prefix"] == compute_storage_filename(
+        snapshots[1]
+    )
+
+    listMock.reset_mock()
+    assert only_stored(snapshots[:1], "whatever", known_stored=known) == snapshots[:1]
+    listMock.assert_not_called()
+
+
+@patch("storage.time.sleep")
+@patch("swiftclient.service.SwiftService.list")
+def test_only_stored_retries_transient_errors(listMock: MagicMock, sleepMock: MagicMock):
+    from swiftclient.exceptions import ClientException
+
+    snapshots = _make_btrfs_snapshots("snap/one")
+    name = compute_storage_filename(snapshots[0])
+    listMock.side_effect = [
+        [{"success": False, "error": ClientException("oops", http_status=503)}],
+        [{"success": True, "listing": [{"name": name}]}],
+    ]
+
+    assert only_stored(snapshots, "whatever_container_name") == snapshots
+    sleepMock.assert_called_once_with(1)
+
+
+@patch("storage.time.sleep")
+@patch("swiftclient.service.SwiftService.list")
+def test_only_stored_does_not_retry_client_errors(
+    listMock: MagicMock, sleepMock: MagicMock
+):
+    from swiftclient.exceptions import ClientException
+
+    snapshots = _make_btrfs_snapshots("snap/one")
+    listMock.return_value = [
+        {"success": False, "error": ClientException("nope", http_status=404)}
+    ]
+
+    with pytest.raises(ClientException):
+        only_stored(snapshots, "whatever_container_name")
+    assert listMock.call_count == 1
+    sleepMock.assert_not_called()
+
+
+def _upload_results(*segment_sizes, error=None):
+    """Results of swift upload, failing with 'error' after uploading segments"""
+    results = [
+        {"success": True, "action": "upload_segment", "segment_size": size}
+        for size in segment_sizes
+    ]
+    if error is not None:
+        return results + [{"success": False, "action": "upload_object", "error": error}]
+    return results + [{"success": True, "action": "upload_object"}]
+
+
+@patch("storage.time.sleep")
+@patch("swiftclient.service.SwiftService.stat")
+@patch("swiftclient.service.SwiftService.upload")
+def test_upload_retries_transient_failures(
+    uploadMock: MagicMock, statMock: MagicMock, sleepMock: MagicMock, tmp_path
+):
+    from swiftclient.exceptions import ClientException
+
+    filepath = tmp_path / "content"
+    filepath.write_bytes(b"content")
+    uploadMock.side_effect = [
+        _upload_results(3, error=ClientException("oops", http_status=503)),
+        _upload_results(3, 4),
+    ]
+
+    progress = list(upload(str(filepath), "whatever_container_name"))
+
+    # Progress restarts with the second attempt
+    assert progress == [0, 3, 0, 3, 7]
+    assert uploadMock.call_count == 2
+    sleepMock.assert_called_once_with(1)
+
+
+@patch("storage.time.sleep")
+@patch("swiftclient.service.SwiftService.stat")
+@patch("swiftclient.service.SwiftService.upload")
+def test_upload_does_not_retry_client_errors(
+    uploadMock: MagicMock, statMock: MagicMock, sleepMock: MagicMock, tmp_path
+):
+    from swiftclient.exceptions import ClientException
+
+    filepath = tmp_path / "content"
+    filepath.write_bytes(b"content")
+    quota_exceeded = ClientException("quota exceeded", http_status=413)
+    uploadMock.return_value = _upload_results(error=quota_exceeded)
+
+    with pytest.raises(UploadFailure) as raised:
+        list(upload(str(filepath), "whatever_container_name"))
+    assert raised.value.__cause__ is quota_exceeded
+    assert uploadMock.call_count == 1
+    sleepMock.assert_not_called()
+
+
 def test_compute_common_prefix():
     l = ["a", "aaa", "aa"]
     assert "a" == _compute_common_prefix(l)
@@ -37,6 +148,15 @@ def test_compute_common_prefix():
     assert "" == _compute_common_prefix(l)
 
 
+def test_compute_segment_size():
+    MiB = 1024 * 1024
+    GiB = 1024 * MiB
+    assert _compute_segment_size(10 * MiB) == 64 * MiB
+    assert _compute_segment_size(5 * GiB) == 512 * MiB
+    assert _compute_segment_size(100 * GiB) == GiB
+    assert _compute_segment_size(2000 * GiB) == 2 * GiB
+
+
 def test_compute_storage_filename():
     name = "prefix/subvol.1"
     assert "prefix\\x2fsubvol.1" == _sanitize_storage_filename(name)
@@ -50,15 +170,34 @@ def test_compute_storage_filename():
         _sanitize_storage_filename(name)
 
 
+def test_compute_list_prefixes():
+    ones = [
+        Snapshot(parent_uuid="one", rel_path=x, abs_path="/", otime=0.0)
+        for x in ("snap/a1", "snap/a2", "snap/a3", "snap/a4", "snap/a5")
+    ]
+    other = Snapshot(parent_uuid="other", rel_path="snap/b", abs_path="/", otime=0.0)
+    snapshots = [*ones[:2], other, *ones[2:]]
+
+    prefixes = _compute_list_prefixes(
+        snapshots, [compute_storage_filename(s) for s in snapshots]
+    )
+
+    assert prefixes == ["one\\x2fsnap\\x2fa", "other\\x2fsnap\\x2fb"]
+
+
 def _configure_list_mock(mock: MagicMock, *names: str):
     """Configure swift list mock for it to return successfully the list of name in parameters"""
     mock.return_value = [{"success": True, "listing": list({"name": x} for x in names)}]
 
 
+_uuid_counter = itertools.count(1)
+"""Deterministic, unique, uuids of faked snapshots"""
+
+
 def _make_btrfs_snapshots(*rel_paths: str):
     """Make list of btrfs snapshots with rel_paths, faking/inferring rest of parameters"""
     return list(
-        Snapshot(parent_uuid=str(uuid.uuid4()), rel_path=x, abs_path="/", otime=0.0)
+        Snapshot(parent_uuid=str(uuid.UUID(int=next(_uuid_counter))), rel_path=x, abs_path="/", otime=0.0)
         for x in rel_paths
     )
 